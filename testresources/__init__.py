@@ -19,8 +19,12 @@
 
 import heapq
 import inspect
+import itertools
 import unittest
-import collections
+try:
+    from collections.abc import MutableSet
+except ImportError:
+    from collections import MutableSet
 try:
     import unittest2
 except ImportError:
@@ -106,7 +110,10 @@ def _kruskals_graph_MST(graph):
         g2 = forest[edge[2]]
         if g1 is g2:
             continue  # already joined
-        # combine g1 and g2 into g1
+        # combine g1 and g2 into g1, always folding the smaller tree into the
+        # larger so that each node is moved O(log N) times in total.
+        if len(g1) < len(g2):
+            g1, g2 = g2, g1
         graphs -= 1
         for from_node, to_nodes in g2.items():
             #remember its symmetric, don't need to do 'to'.
@@ -156,15 +163,30 @@ def split_by_resources(tests):
     contains an entry for "no resources".
     """
     no_resources = frozenset()
-    resource_set_tests = {no_resources: []}
+    no_resource_tests = []
+    resource_set_tests = {no_resources: no_resource_tests}
+    # Many tests share the same resources (typically via a class attribute),
+    # so the closure of needed resources is computed once per distinct
+    # combination of managers.
+    needed_resource_sets = {}
+    # Bound locally: this is called once per test in the suite.
+    add_no_resource_test = no_resource_tests.append
+    setdefault = resource_set_tests.setdefault
     for test in tests:
-        resources = getattr(test, "resources", ())
-        all_resources = list(resource.neededResources()
-                             for _, resource in resources)
-        resource_set = set()
-        for resource_list in all_resources:
-            resource_set.update(resource_list)
-        resource_set_tests.setdefault(frozenset(resource_set), []).append(test)
+        resources = getattr(test, "resources", None)
+        if not resources:
+            add_no_resource_test(test)
+            continue
+        managers = tuple(resource for _, resource in resources)
+        resource_set = needed_resource_sets.get(managers)
+        if resource_set is None:
+            resource_set = set()
+            update = resource_set.update
+            for resource in managers:
+                update(resource.neededResources())
+            resource_set = frozenset(resource_set)
+            needed_resource_sets[managers] = resource_set
+        setdefault(resource_set, []).append(test)
     return resource_set_tests
 
 
@@ -185,14 +207,18 @@ def _strongly_connected_components(graph, no_resources):
             # add all the nodes connected to a connected node to pending.
             node = pending.pop()
             current_partition.add(node)
-            pending.update(graph.pop(node, []))
-            # don't try to process things we've allready processed.
-            pending.difference_update(current_partition)
+            # don't try to process things we've allready processed. This is a
+            # per-node membership check rather than a difference_update
+            # against the whole partition, which was quadratic in the
+            # partition size.
+            for connected in graph.pop(node, ()):
+                if connected not in current_partition:
+                    pending.add(connected)
         partitions.append(current_partition)
     return partitions
 
 
-class _OrderedSet(collections.MutableSet):
+class _OrderedSet(MutableSet):
     """This is taken from the OrderedSet recipe link in the Python 2 docs.
 
     See:
@@ -202,6 +228,10 @@ class _OrderedSet(collections.MutableSet):
 
     """
 
+    # run() and switch() create several of these per test, and the ABC bases
+    # declare empty __slots__, so this drops the per-instance __dict__.
+    __slots__ = ('end', 'map')
+
     def __init__(self, iterable=None):
         self.end = end = []
         end += [None, end, end]         # sentinel node for doubly linked list
@@ -261,19 +291,32 @@ class OptimisingTestSuite(unittest.TestSuite):
         while any custom test suites will be 'distributed' across their
         members. Thus addTest(CustomSuite([a, b])) will result in
         CustomSuite([a]) and CustomSuite([b]) being added to this suite.
+
+        Nested suites are unwrapped here without calling addTest (or the
+        deprecated adsorbSuite) again for their members, so an override of
+        either sees only the object passed in by the caller.
         """
-        try:
-            tests = iter(test_case_or_suite)
-        except TypeError:
-            unittest.TestSuite.addTest(self, test_case_or_suite)
-            return
-        if test_case_or_suite.__class__ in self.__class__.known_suite_classes:
-            for test in tests:
-                self.adsorbSuite(test)
-        else:
-            for test in tests:
-                unittest.TestSuite.addTest(
-                    self, test_case_or_suite.__class__([test]))
+        # Flatten with an explicit stack rather than recursing, so deeply
+        # nested suites don't cost a Python frame per level.
+        known_suite_classes = self.__class__.known_suite_classes
+        pending = [test_case_or_suite]
+        while pending:
+            test = pending.pop()
+            if isinstance(test, unittest.TestCase):
+                # The common case: nothing to unwrap.
+                unittest.TestSuite.addTest(self, test)
+                continue
+            if test.__class__ in known_suite_classes:
+                # Reversed so that members are popped in their original order.
+                pending.extend(reversed(list(test)))
+                continue
+            try:
+                tests = iter(test)
+            except TypeError:
+                unittest.TestSuite.addTest(self, test)
+                continue
+            for member in tests:
+                unittest.TestSuite.addTest(self, test.__class__([member]))
 
     def cost_of_switching(self, old_resource_set, new_resource_set):
         """Cost of switching from 'old_resource_set' to 'new_resource_set'.
@@ -381,31 +424,20 @@ class OptimisingTestSuite(unittest.TestSuite):
             not included.
         """
         no_resources = frozenset()
-        graph = {}
         root = set(['root'])
-        # bottom = set(['bottom'])
-        for from_set in resource_sets:
-            graph[from_set] = {}
+        graph = dict((resource_set, {}) for resource_set in resource_sets)
+        cost_of_switching = self.cost_of_switching
+        # permutations gives every ordered pair of distinct nodes, so there
+        # are no self-edges.
+        for from_set, to_set in itertools.permutations(graph, 2):
+            if to_set == root:
+                continue  # no links to root
             if from_set == root:
                 from_resources = no_resources
-            #elif from_set == bottom:
-            #    continue # no links from bottom
             else:
                 from_resources = from_set
-            for to_set in resource_sets:
-                if from_set is to_set:
-                    continue  # no self-edges
-                #if to_set == bottom:
-                #   if from_set == root:
-                #       continue # no short cuts!
-                #   to_resources = no_resources
-                #el
-                if to_set == root:
-                    continue  # no links to root
-                else:
-                    to_resources = to_set
-                graph[from_set][to_set] = self.cost_of_switching(
-                        from_resources, to_resources)
+            graph[from_set][to_set] = cost_of_switching(
+                from_resources, to_set)
         return graph
 
     def _makeOrder(self, partition):
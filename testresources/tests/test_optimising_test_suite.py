@@ -15,9 +15,10 @@
 #  license.
 #
 
+import itertools
 import six
 import testtools
-import random
+import sys
 import testresources
 from testresources import split_by_resources
 from testresources.tests import ResultWithResourceExtensions
@@ -65,24 +66,30 @@ class MakeCounter(testresources.TestResource):
         return resource
 
 
-class TestOptimisingTestSuite(testtools.TestCase):
+def makeTestCase(test_running_hook=None):
+    """Make a normal TestCase.
 
-    def makeTestCase(self, test_running_hook=None):
-        """Make a normal TestCase."""
-        class TestCaseForTesting(unittest.TestCase):
-            def runTest(self):
-                if test_running_hook:
-                    test_running_hook(self)
-        return TestCaseForTesting('runTest')
-
-    def makeResourcedTestCase(self, resource_manager, test_running_hook):
-        """Make a ResourcedTestCase."""
-        class ResourcedTestCaseForTesting(testresources.ResourcedTestCase):
-            def runTest(self):
+    A new class is made per call: TestCase equality compares only the class
+    and method name, and tests here compare lists of cases to check order.
+    """
+    class TestCaseForTesting(unittest.TestCase):
+        def runTest(self):
+            if test_running_hook:
                 test_running_hook(self)
-        test_case = ResourcedTestCaseForTesting('runTest')
-        test_case.resources = [('_default', resource_manager)]
-        return test_case
+    return TestCaseForTesting('runTest')
+
+
+def makeResourcedTestCase(resource_manager, test_running_hook):
+    """Make a ResourcedTestCase, see makeTestCase."""
+    class ResourcedTestCaseForTesting(testresources.ResourcedTestCase):
+        def runTest(self):
+            test_running_hook(self)
+    test_case = ResourcedTestCaseForTesting('runTest')
+    test_case.resources = [('_default', resource_manager)]
+    return test_case
+
+
+class TestOptimisingTestSuite(testtools.TestCase):
 
     def setUp(self):
         super(TestOptimisingTestSuite, self).setUp()
@@ -91,14 +98,14 @@ class TestOptimisingTestSuite(testtools.TestCase):
     def testAddTest(self):
         # Adding a single test case is the same as adding one using the
         # standard addTest.
-        case = self.makeTestCase()
+        case = makeTestCase()
         self.optimising_suite.addTest(case)
         self.assertEqual([case], self.optimising_suite._tests)
 
     def testAddTestSuite(self):
         # Adding a standard test suite is the same as adding all the tests in
         # that suite.
-        case = self.makeTestCase()
+        case = makeTestCase()
         suite = unittest.TestSuite([case])
         self.optimising_suite.addTest(suite)
         self.assertEqual([case], self.optimising_suite._tests)
@@ -107,14 +114,14 @@ class TestOptimisingTestSuite(testtools.TestCase):
     def testAddUnittest2TestSuite(self):
         # Adding a unittest2 test suite is the same as adding all the tests in
         # that suite.
-        case = self.makeTestCase()
+        case = makeTestCase()
         suite = unittest2.TestSuite([case])
         self.optimising_suite.addTest(suite)
         self.assertEqual([case], self.optimising_suite._tests)
 
     def testAddTestOptimisingTestSuite(self):
         # when adding an optimising test suite, it should be unpacked.
-        case = self.makeTestCase()
+        case = makeTestCase()
         suite1 = testresources.OptimisingTestSuite([case])
         suite2 = testresources.OptimisingTestSuite([case])
         self.optimising_suite.addTest(suite1)
@@ -124,20 +131,57 @@ class TestOptimisingTestSuite(testtools.TestCase):
     def testAddFlattensStandardSuiteStructure(self):
         # addTest will get rid of all unittest.TestSuite structure when adding
         # a test, no matter how much nesting is going on.
-        case1 = self.makeTestCase()
-        case2 = self.makeTestCase()
-        case3 = self.makeTestCase()
+        case1 = makeTestCase()
+        case2 = makeTestCase()
+        case3 = makeTestCase()
         suite = unittest.TestSuite(
             [unittest.TestSuite([case1, unittest.TestSuite([case2])]),
              case3])
         self.optimising_suite.addTest(suite)
         self.assertEqual([case1, case2, case3], self.optimising_suite._tests)
 
+    def testAddFlattensDeeplyNestedSuites(self):
+        # Nesting deeper than the recursion limit is still flattened.
+        case = makeTestCase()
+        suite = case
+        for _ in range(sys.getrecursionlimit() + 10):
+            suite = unittest.TestSuite([suite])
+        self.optimising_suite.addTest(suite)
+        self.assertEqual([case], self.optimising_suite._tests)
+
+    def testAddDoesNotRedispatchNestedMembers(self):
+        # Flattening happens inside addTest: an override is called once for
+        # the object passed in, not again for each nested member.
+        added = []
+        class LoggingSuite(testresources.OptimisingTestSuite):
+            def addTest(self, test):
+                added.append(test)
+                super(LoggingSuite, self).addTest(test)
+        case1 = makeTestCase()
+        case2 = makeTestCase()
+        outer = unittest.TestSuite([case1, unittest.TestSuite([case2])])
+        suite = LoggingSuite()
+        suite.addTest(outer)
+        self.assertEqual([id(outer)], [id(test) for test in added])
+        self.assertEqual([id(case1), id(case2)],
+                         [id(test) for test in suite._tests])
+
+    def testAddFlattenPreservesOrderAndRepeats(self):
+        # Flattening keeps the original order of tests, and a test present
+        # more than once is kept each time it appears.
+        case1 = makeTestCase()
+        case2 = makeTestCase()
+        suite = unittest.TestSuite(
+            [case2, unittest.TestSuite([case1, case2]), case1])
+        self.optimising_suite.addTest(suite)
+        self.assertEqual(
+            [case2, case1, case2, case1], self.optimising_suite._tests)
+
     def testAddDistributesNonStandardSuiteStructure(self):
         # addTest distributes all non-standard TestSuites across their
         # members.
-        case1 = self.makeTestCase()
-        case2 = self.makeTestCase()
+        case1 = makeTestCase()
+        case2 = makeTestCase()
         inner_suite = unittest.TestSuite([case2])
         suite = CustomSuite([case1, inner_suite])
         self.optimising_suite.addTest(suite)
@@ -145,12 +189,29 @@ class TestOptimisingTestSuite(testtools.TestCase):
             [CustomSuite([case1]), CustomSuite([inner_suite])],
             self.optimising_suite._tests)
 
+    def testAddFlattensKnownSuitesViaIteration(self):
+        # Registered suite classes are unwrapped through the iteration
+        # protocol, not by reaching into their storage.
+        case1 = makeTestCase()
+        case2 = makeTestCase()
+        class IteratingSuite(object):
+            def __init__(self, tests):
+                self.tests = tests
+            def __iter__(self):
+                return iter(self.tests)
+        self.patch(testresources.OptimisingTestSuite, 'known_suite_classes',
+            testresources.OptimisingTestSuite.known_suite_classes +
+            (IteratingSuite,))
+        self.optimising_suite.addTest(IteratingSuite([case1, case2]))
+        self.assertEqual([id(case1), id(case2)],
+                         [id(test) for test in self.optimising_suite._tests])
+
     def testAddPullsNonStandardSuitesUp(self):
         # addTest flattens standard TestSuites, even those that contain custom
         # suites. When it reaches the custom suites, it distributes them
         # across their members.
-        case1 = self.makeTestCase()
-        case2 = self.makeTestCase()
+        case1 = makeTestCase()
+        case2 = makeTestCase()
         inner_suite = CustomSuite([case1, case2])
         self.optimising_suite.addTest(
             unittest.TestSuite([unittest.TestSuite([inner_suite])]))
@@ -158,37 +219,9 @@ class TestOptimisingTestSuite(testtools.TestCase):
             [CustomSuite([case1]), CustomSuite([case2])],
             self.optimising_suite._tests)
 
-    def testSingleCaseResourceAcquisition(self):
-        sample_resource = MakeCounter()
-        def getResourceCount(test):
-            self.assertEqual(sample_resource._uses, 2)
-        case = self.makeResourcedTestCase(sample_resource, getResourceCount)
-        self.optimising_suite.addTest(case)
-        result = unittest.TestResult()
-        self.optimising_suite.run(result)
-        self.assertEqual(result.testsRun, 1)
-        self.assertEqual(result.wasSuccessful(), True)
-        self.assertEqual(sample_resource._uses, 0)
-
-    def testResourceReuse(self):
-        make_counter = MakeCounter()
-        def getResourceCount(test):
-            self.assertEqual(make_counter._uses, 2)
-        case = self.makeResourcedTestCase(make_counter, getResourceCount)
-        case2 = self.makeResourcedTestCase(make_counter, getResourceCount)
-        self.optimising_suite.addTest(case)
-        self.optimising_suite.addTest(case2)
-        result = unittest.TestResult()
-        self.optimising_suite.run(result)
-        self.assertEqual(result.testsRun, 2)
-        self.assertEqual(result.wasSuccessful(), True)
-        self.assertEqual(make_counter._uses, 0)
-        self.assertEqual(make_counter.makes, 1)
-        self.assertEqual(make_counter.cleans, 1)
-
     def testResultPassedToResources(self):
         resource_manager = MakeCounter()
-        test_case = self.makeTestCase(lambda x:None)
+        test_case = makeTestCase(lambda x:None)
         test_case.resources = [('_default', resource_manager)]
         self.optimising_suite.addTest(test_case)
         result = ResultWithResourceExtensions()
@@ -197,36 +230,25 @@ class TestOptimisingTestSuite(testtools.TestCase):
         # resource aware test, it won't make any calls itself.
         self.assertEqual(4, len(result._calls))
 
-    def testOptimisedRunNonResourcedTestCase(self):
-        case = self.makeTestCase()
-        self.optimising_suite.addTest(case)
-        result = unittest.TestResult()
-        self.optimising_suite.run(result)
-        self.assertEqual(result.testsRun, 1)
-        self.assertEqual(result.wasSuccessful(), True)
-
     def testSortTestsCalled(self):
         # OptimisingTestSuite.run() calls sortTests on the suite.
-        class MockOptimisingTestSuite(testresources.OptimisingTestSuite):
-            def sortTests(self):
-                self.sorted = True
-
-        suite = MockOptimisingTestSuite()
-        suite.sorted = False
+        suite = testresources.OptimisingTestSuite()
+        calls = []
+        suite.sortTests = lambda: calls.append('sortTests')
         suite.run(None)
-        self.assertEqual(suite.sorted, True)
+        self.assertEqual(['sortTests'], calls)
 
     def testResourcesDroppedForNonResourcedTestCase(self):
         sample_resource = MakeCounter()
         def resourced_case_hook(test):
             self.assertTrue(sample_resource._uses > 0)
-        self.optimising_suite.addTest(self.makeResourcedTestCase(
+        self.optimising_suite.addTest(makeResourcedTestCase(
             sample_resource, resourced_case_hook))
         def normal_case_hook(test):
             # The resource should not be acquired when the normal test
             # runs.
             self.assertEqual(sample_resource._uses, 0)
-        self.optimising_suite.addTest(self.makeTestCase(normal_case_hook))
+        self.optimising_suite.addTest(makeTestCase(normal_case_hook))
         result = unittest.TestResult()
         self.optimising_suite.run(result)
         self.assertEqual(result.testsRun, 2)
@@ -238,7 +260,7 @@ class TestOptimisingTestSuite(testtools.TestCase):
         make_counter = MakeCounter()
         def dirtyResource(test):
             make_counter.dirtied(test._default)
-        case = self.makeResourcedTestCase(make_counter, dirtyResource)
+        case = makeResourcedTestCase(make_counter, dirtyResource)
         self.optimising_suite.addTest(case)
         result = unittest.TestResult()
         self.optimising_suite.run(result)
@@ -254,8 +276,8 @@ class TestOptimisingTestSuite(testtools.TestCase):
             make_counter.dirtied(test._default)
         def testTwo(test):
             make_counter.calls.append('test two')
-        case1 = self.makeResourcedTestCase(make_counter, testOne)
-        case2 = self.makeResourcedTestCase(make_counter, testTwo)
+        case1 = makeResourcedTestCase(make_counter, testOne)
+        case2 = makeResourcedTestCase(make_counter, testTwo)
         self.optimising_suite.addTest(case1)
         self.optimising_suite.addTest(case2)
         result = unittest.TestResult()
@@ -297,7 +319,7 @@ class TestOptimisingTestSuite(testtools.TestCase):
         resource_two = Resource('two')
         resource_two.resources = [('one', resource_one)]
 
-        test_case = self.makeTestCase(lambda x: None)
+        test_case = makeTestCase(lambda x: None)
         test_case.resources = [('two', resource_two)]
 
         self.optimising_suite.addTest(test_case)
@@ -311,7 +333,67 @@ class TestOptimisingTestSuite(testtools.TestCase):
         self.assertEqual(cleans, ['two', 'one'])
 
 
-class TestSplitByResources(testtools.TestCase):
+class TestOptimisingTestSuiteBatched(testtools.TestCase):
+    """Resource acquisition checks sharing one run of disjoint scenarios.
+
+    The captured state is held on the class and is read-only for the tests.
+    """
+
+    # Set by _runBatch once the shared suite has run to completion.
+    result = None
+
+    # Not setUpClass: OptimisingTestSuite.run, and so testresources.TestLoader,
+    # does not run class fixtures.
+    def setUp(self):
+        super(TestOptimisingTestSuiteBatched, self).setUp()
+        if TestOptimisingTestSuiteBatched.result is None:
+            TestOptimisingTestSuiteBatched._runBatch()
+
+    @classmethod
+    def _runBatch(cls):
+        # resource -> the number of uses seen by each test using it.
+        cls.uses_seen = {}
+        cls.normal_case_runs = []
+        def recordUses(resource):
+            def hook(test):
+                cls.uses_seen.setdefault(resource, []).append(resource._uses)
+            return hook
+        normal_case = makeTestCase(cls.normal_case_runs.append)
+        cls.single_resource = MakeCounter()
+        cls.shared_resource = MakeCounter()
+        suite = testresources.OptimisingTestSuite()
+        suite.addTest(normal_case)
+        suite.addTest(makeResourcedTestCase(
+            cls.single_resource, recordUses(cls.single_resource)))
+        for _ in range(2):
+            suite.addTest(makeResourcedTestCase(
+                cls.shared_resource, recordUses(cls.shared_resource)))
+        result = unittest.TestResult()
+        suite.run(result)
+        # Only now, so a run that raises is retried (and reported) by the
+        # next test rather than leaving partial state behind.
+        cls.result = result
+
+    def testAllCasesRunSuccessfully(self):
+        self.assertEqual(self.result.testsRun, 4)
+        self.assertEqual(self.result.wasSuccessful(), True)
+
+    def testSingleCaseResourceAcquisition(self):
+        # The suite and the test case each hold the resource while it runs.
+        self.assertEqual([2], self.uses_seen[self.single_resource])
+        self.assertEqual(self.single_resource._uses, 0)
+
+    def testResourceReuse(self):
+        self.assertEqual([2, 2], self.uses_seen[self.shared_resource])
+        self.assertEqual(self.shared_resource._uses, 0)
+        self.assertEqual(self.shared_resource.makes, 1)
+        self.assertEqual(self.shared_resource.cleans, 1)
+
+    def testOptimisedRunNonResourcedTestCase(self):
+        self.assertEqual(1, len(self.normal_case_runs))
+
+
+class TestSplitByResources(unittest.TestCase):
     """Tests for split_by_resources."""
 
     def makeTestCase(self):
@@ -361,6 +443,23 @@ class TestSplitByResources(testtools.TestCase):
                           frozenset([resource1, resource2]): [resourced_case]},
                          resource_set_tests)
 
+    def testSharedResourcesResolvedOnce(self):
+        resource = testresources.TestResource()
+        calls = []
+        def neededResources():
+            calls.append(None)
+            return [resource]
+        resource.neededResources = neededResources
+        cases = [self.makeResourcedTestCase(has_resource=False)
+                 for i in range(3)]
+        for case in cases:
+            case.resources = [('resource', resource)]
+        resource_set_tests = split_by_resources(cases)
+        self.assertEqual(
+            [id(case) for case in cases],
+            [id(case) for case in resource_set_tests[frozenset([resource])]])
+        self.assertEqual(1, len(calls))
+
     def testResourcedCaseWithNoResources(self):
         resourced_case = self.makeResourcedTestCase(has_resource=False)
         resource_set_tests = split_by_resources([resourced_case])
@@ -371,18 +470,21 @@ class TestSplitByResources(testtools.TestCase):
         normal_cases.extend([
             self.makeResourcedTestCase(has_resource=False) for i in range(3)])
         resourced_cases = [self.makeResourcedTestCase() for i in range(3)]
-        all_cases = normal_cases + resourced_cases
-        # XXX: Maybe I shouldn't be using random here.
-        random.shuffle(all_cases)
+        # Interleave deterministically: two normal cases, then a resourced
+        # one. Normal cases keep their relative order after the split.
+        all_cases = list(itertools.chain.from_iterable(
+            zip(normal_cases[::2], normal_cases[1::2], resourced_cases)))
         resource_set_tests = split_by_resources(all_cases)
-        self.assertEqual(set(normal_cases),
-                         set(resource_set_tests[frozenset()]))
+        # TestCases with the same class and method compare equal, so compare
+        # identities to check the order.
+        self.assertEqual([id(case) for case in normal_cases],
+                         [id(case) for case in resource_set_tests[frozenset()]])
         for case in resourced_cases:
             resource = case.resources[0][1]
             self.assertEqual([case], resource_set_tests[frozenset([resource])])
 
 
-class TestCostOfSwitching(testtools.TestCase):
+class TestCostOfSwitching(unittest.TestCase):
     """Tests for cost_of_switching."""
 
     def setUp(self):
@@ -435,7 +537,7 @@ class TestCostOfSwitching(testtools.TestCase):
             2, self.suite.cost_of_switching(set([a, c]), set([b, c])))
 
 
-class TestCostGraph(testtools.TestCase):
+class TestCostGraph(unittest.TestCase):
     """Tests for calculating the cost graph of resourced test cases."""
 
     def makeResource(self, setUpCost=1, tearDownCost=1):
@@ -507,38 +609,10 @@ class TestGraphStuff(testtools.TestCase):
         return suite._tests
 
     def _permute_four(self, cases):
-        case1, case2, case3, case4 = cases
-        permutations = []
-        permutations.append([case1, case2, case3, case4])
-        permutations.append([case1, case2, case4, case3])
-        permutations.append([case1, case3, case2, case4])
-        permutations.append([case1, case3, case4, case2])
-        permutations.append([case1, case4, case2, case3])
-        permutations.append([case1, case4, case3, case2])
-
-        permutations.append([case2, case1, case3, case4])
-        permutations.append([case2, case1, case4, case3])
-        permutations.append([case2, case3, case1, case4])
-        permutations.append([case2, case3, case4, case1])
-        permutations.append([case2, case4, case1, case3])
-        permutations.append([case2, case4, case3, case1])
-
-        permutations.append([case3, case2, case1, case4])
-        permutations.append([case3, case2, case4, case1])
-        permutations.append([case3, case1, case2, case4])
-        permutations.append([case3, case1, case4, case2])
-        permutations.append([case3, case4, case2, case1])
-        permutations.append([case3, case4, case1, case2])
-
-        permutations.append([case4, case2, case3, case1])
-        permutations.append([case4, case2, case1, case3])
-        permutations.append([case4, case3, case2, case1])
-        permutations.append([case4, case3, case1, case2])
-        permutations.append([case4, case1, case2, case3])
-        permutations.append([case4, case1, case3, case2])
-        return permutations
-
-    @unittest2.skipIf(six.PY3, "Flaky on Python 3, see LP #1645008")
+        return [list(permutation)
+                for permutation in itertools.permutations(cases)]
+
+    @testtools.skipIf(six.PY3, "Flaky on Python 3, see LP #1645008")
     def testBasicSortTests(self):
         # Test every permutation of inputs, with legacy tests.
         # Cannot use equal costs because of the use of
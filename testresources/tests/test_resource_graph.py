@@ -61,6 +61,31 @@ class TestResourceGraph(testtools.TestCase):
             result)
 
 
+class TestStronglyConnectedComponents(testtools.TestCase):
+
+    def test_discrete(self):
+        resset1 = frozenset([testresources.TestResourceManager()])
+        resset2 = frozenset([testresources.TestResourceManager()])
+        graph = _resource_graph([resset1, resset2])
+        partitions = testresources._strongly_connected_components(
+            graph, frozenset())
+        self.assertEqual(2, len(partitions))
+        self.assertEqual(
+            set([frozenset([resset1]), frozenset([resset2])]),
+            set(frozenset(partition) for partition in partitions))
+
+    def test_chain(self):
+        # A chain of overlapping resource sets is a single partition, even
+        # though the ends share no resources.
+        res = [testresources.TestResourceManager() for _ in range(5)]
+        ressets = [frozenset(res[pos:pos + 2]) for pos in range(4)]
+        graph = _resource_graph(ressets)
+        partitions = testresources._strongly_connected_components(
+            graph, frozenset())
+        self.assertEqual([set(ressets)], [set(p) for p in partitions])
+        self.assertEqual({}, graph)
+
+
 class TestDigraphToGraph(testtools.TestCase):
 
     def test_wikipedia_example(self):